@@ -1,26 +1,83 @@
+import eventlet
+eventlet.monkey_patch()
+from eventlet.hubs import trampoline
+
 import os
+import atexit
+import bisect
+import functools
+import inspect
 import bcrypt
-from flask import Flask, render_template, request, send_from_directory, session
+from flask import Flask, Response, render_template, request, send_from_directory, session, abort
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from eventlet import tpool
+from PIL import Image, ImageOps
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import extensions, sql
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2.errors import UniqueViolation
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 import base64
+import binascii
+import io
+import json
 from datetime import datetime, timedelta
 import re
 import hashlib
+import html
+import mimetypes
+import random
 import secrets
+import select
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['AVATAR_FOLDER'] = os.path.join('uploads', 'avatars')
+app.config['PARTIAL_FOLDER'] = os.path.join('uploads', 'partial')
+app.config['FILES_FOLDER'] = os.path.join('uploads', 'files')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25)
+# Префикс internal-location nginx, указывающей на uploads/ (например /_uploads/); пусто — отдаёт сам gunicorn
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '')
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+LAST_TEXT_PREVIEW = 100
+AVATAR_MAX_SIZE = 1024 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+PROFILE_CACHE_SIZE = 10000
+NORMALIZE_BATCH_SIZE = 5000
+RECENT_HISTORY_SIZE = 200
+FAVORITES_CACHE_SIZE = 10000
+CHAT_CACHE_SIZE = 50000
+ATTACHMENT_CACHE_SIZE = 10000
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 20 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_TTL = 3600
+AVATAR_SIZE = 256
+THUMBNAIL_SIZE = 480
+IMAGE_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+# Вложения, которые браузер может показать сам; всё остальное (HTML, SVG, ...) отдаётся на скачивание
+INLINE_PREFIXES = ('audio/', 'video/')
+BROADCAST_BACKEND = os.environ.get('BROADCAST_BACKEND', 'local')
+NOTIFY_PAYLOAD_LIMIT = 7000
+LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 5))
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', 4))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', 32))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 30 * 24 * 3600))
+SESSION_CACHE_TTL = 300
+SESSION_CACHE_SIZE = 10000
+SEARCH_LIMIT = 20
+SEARCH_CONFIG = 'russian'
 
 # === PostgreSQL подключение ===
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -38,20 +95,495 @@ else:
     DB_USER = 'messka_user'
     DB_PASS = 'messka'
 
-def get_db_connection():
-    return psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, database=DB_NAME,
-        user=DB_USER, password=DB_PASS,
-        cursor_factory=RealDictCursor
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', 30))
+DB_GREEN = os.environ.get('DB_GREEN', '1') == '1'
+
+def eventlet_wait_callback(conn, timeout=-1):
+    """Ожидание ответа PostgreSQL через хаб eventlet вместо блокирующего сокета."""
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+if DB_GREEN:
+    extensions.set_wait_callback(eventlet_wait_callback)
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Пул соединений с ограничением размера, таймаутом ожидания и проверкой при выдаче."""
+
+    def __init__(self, minconn, maxconn, timeout, check_idle, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._connect_kwargs = connect_kwargs
+        self._idle = []  # [(conn, last_used)]
+        self._size = 0
+        self._filled = False
+        self._cond = threading.Condition()
+
+    def connect(self):
+        """Новое соединение с параметрами пула; вне пула используется для LISTEN."""
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _fill(self):
+        self._filled = True
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self.connect()
+            except Exception:
+                self._release_slot()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot()
+
+    def getconn(self):
+        if not self._filled:
+            self._fill()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f'Нет свободных соединений за {self.timeout} с')
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    conn, last_used = None, None
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._filled = False
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'max': self.maxconn}
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.putconn(conn, discard=True)
+            else:
+                self.putconn(conn)
+            raise
+        self.putconn(conn)
+
+db_pool = ConnectionPool(
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE,
+    host=DB_HOST, port=DB_PORT, database=DB_NAME,
+    user=DB_USER, password=DB_PASS,
+    cursor_factory=RealDictCursor
+)
+
+@contextmanager
+def db_cursor():
+    """Курсор из пула: commit при успехе, rollback при исключении."""
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+# === МЕТРИКИ ===
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+latency_metrics = {}  # {(kind, name): [count, errors, sum, [попаданий в каждую корзину]]}
+
+def record_latency(kind, name, seconds, failed=False):
+    metric = latency_metrics.get((kind, name))
+    if metric is None:
+        metric = latency_metrics[(kind, name)] = [0, 0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+    metric[0] += 1
+    metric[1] += failed
+    metric[2] += seconds
+    metric[3][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+def instrumented(kind, name=None):
+    """Декоратор: число вызовов, ошибок и гистограмма задержки под меткой kind/name.
+
+    Накладные расходы — два perf_counter и несколько операций со списком; блокировка
+    не нужна, пока вызовы идут из green-потоков одного хаба.
+    """
+    def decorator(func):
+        label = name or func.__name__
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record_latency(kind, label, time.perf_counter() - start, failed)
+        return wrapper
+    return decorator
+
+def prometheus_histograms(metric, kind, label):
+    """Гистограммы и счётчики ошибок одного вида в текстовом формате Prometheus."""
+    lines = [
+        f'# HELP {metric}_seconds Latency of {kind} calls',
+        f'# TYPE {metric}_seconds histogram',
+    ]
+    errors = [
+        f'# HELP {metric}_errors_total Failed {kind} calls',
+        f'# TYPE {metric}_errors_total counter',
+    ]
+    for (metric_kind, name), (count, failed, total, buckets) in sorted(latency_metrics.items()):
+        if metric_kind != kind:
+            continue
+        cumulative = 0
+        for bound, hits in zip(LATENCY_BUCKETS, buckets):
+            cumulative += hits
+            lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="+Inf"}} {count}')
+        lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {total:.6f}')
+        lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {count}')
+        errors.append(f'{metric}_errors_total{{{label}="{name}"}} {failed}')
+    return lines + errors
+
+def prometheus_gauges(gauges):
+    lines = []
+    for metric, (help_text, value) in gauges.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge', f'{metric} {value}']
+    return lines
+
+# === СХЕМА ===
+SCHEMA_STATEMENTS = [
+    "CREATE INDEX IF NOT EXISTS idx_private_messages_chat_id ON private_messages (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_private_chats_user1 ON private_chats (user1_id)",
+    "CREATE INDEX IF NOT EXISTS idx_private_chats_user2 ON private_chats (user2_id)",
+    """
+    CREATE TABLE IF NOT EXISTS private_chat_summary (
+        chat_id VARCHAR(16) PRIMARY KEY,
+        last_message_id INTEGER,
+        last_text TEXT,
+        last_at TIMESTAMP,
+        user1_unread INTEGER NOT NULL DEFAULT 0,
+        user2_unread INTEGER NOT NULL DEFAULT 0,
+        user1_last_read_id INTEGER NOT NULL DEFAULT 0,
+        user2_last_read_id INTEGER NOT NULL DEFAULT 0
     )
+    """,
+    "ALTER TABLE private_chat_summary ADD COLUMN IF NOT EXISTS user1_last_read_id INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE private_chat_summary ADD COLUMN IF NOT EXISTS user2_last_read_id INTEGER NOT NULL DEFAULT 0",
+    f"""
+    INSERT INTO private_chat_summary (chat_id, last_message_id, last_text, last_at, user1_unread, user2_unread)
+    SELECT pc.chat_id, last.id, LEFT(COALESCE(last.message_text, last.filename), {LAST_TEXT_PREVIEW}), last.created_at,
+           (SELECT COUNT(*) FROM private_messages
+            WHERE chat_id = pc.chat_id AND receiver_id = pc.user1_id AND is_read = FALSE),
+           (SELECT COUNT(*) FROM private_messages
+            WHERE chat_id = pc.chat_id AND receiver_id = pc.user2_id AND is_read = FALSE)
+    FROM private_chats pc
+    LEFT JOIN LATERAL (
+        SELECT id, message_text, filename, created_at FROM private_messages
+        WHERE chat_id = pc.chat_id
+        ORDER BY id DESC LIMIT 1
+    ) last ON TRUE
+    WHERE NOT EXISTS (SELECT 1 FROM private_chat_summary s WHERE s.chat_id = pc.chat_id)
+    """,
+    # Отметки прочтения из старого поля is_read для чатов, где их ещё нет
+    """
+    UPDATE private_chat_summary s
+    SET user1_last_read_id = COALESCE((
+            SELECT MAX(id) FROM private_messages
+            WHERE chat_id = s.chat_id AND receiver_id = pc.user1_id AND is_read = TRUE), 0),
+        user2_last_read_id = COALESCE((
+            SELECT MAX(id) FROM private_messages
+            WHERE chat_id = s.chat_id AND receiver_id = pc.user2_id AND is_read = TRUE), 0)
+    FROM private_chats pc
+    WHERE pc.chat_id = s.chat_id AND s.user1_last_read_id = 0 AND s.user2_last_read_id = 0
+    """,
+    # Профиль отправителя берётся из users по user_id, копии в messages больше не пишутся
+    "ALTER TABLE messages ALTER COLUMN username DROP NOT NULL",
+    "ALTER TABLE messages ALTER COLUMN user_tag DROP NOT NULL",
+    "ALTER TABLE messages ALTER COLUMN avatar DROP NOT NULL",
+    """
+    CREATE TABLE IF NOT EXISTS attachments (
+        sha256 CHAR(64) PRIMARY KEY,
+        size BIGINT NOT NULL,
+        mime_type VARCHAR(255) NOT NULL,
+        original_name VARCHAR(255) NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        thumb_width INTEGER,
+        thumb_height INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS thumb_width INTEGER",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS thumb_height INTEGER",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS attachment_sha256 CHAR(64)",
+    "ALTER TABLE private_messages ADD COLUMN IF NOT EXISTS attachment_sha256 CHAR(64)",
+    """
+    CREATE TABLE IF NOT EXISTS socketio_events (
+        id BIGSERIAL PRIMARY KEY,
+        payload TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # В базе только sha256 от токена: утечка таблицы не даёт войти под чужой сессией
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash CHAR(64) PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        expires_at TIMESTAMP NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id)",
+    # Поиск по юзернейму: префикс — по btree в порядке "C", подстрока — по триграммам
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    'CREATE INDEX IF NOT EXISTS idx_users_tag_prefix ON users ((user_tag COLLATE "C"))',
+    "CREATE INDEX IF NOT EXISTS idx_users_tag_trgm ON users USING GIN (user_tag gin_trgm_ops)",
+    # Полнотекстовый поиск: вычисляемая колонка обновляется самим Postgres при вставке
+    f"""
+    ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', COALESCE(message_text, ''))) STORED
+    """,
+    f"""
+    ALTER TABLE private_messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', COALESCE(message_text, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector)",
+    "CREATE INDEX IF NOT EXISTS idx_private_messages_search ON private_messages USING GIN (search_vector)",
+    # Одна пара пользователей — один чат, в каком бы порядке они ни были записаны
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_private_chats_pair
+    ON private_chats (LEAST(user1_id, user2_id), GREATEST(user1_id, user2_id))
+    """,
+]
+
+def init_db():
+    with db_cursor() as cur:
+        for statement in SCHEMA_STATEMENTS:
+            cur.execute(statement)
+
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    print('✅ Схема обновлена')
+
+# === РАССЫЛКА МЕЖДУ ВОРКЕРАМИ ===
+class PostgresManager(PubSubManager):
+    """Менеджер клиентов python-socketio, пересылающий emit между процессами через LISTEN/NOTIFY.
+
+    Payload NOTIFY ограничен 8000 байт, поэтому крупные события кладутся в socketio_events,
+    а в уведомлении передаётся только '@<id>' строки.
+    """
+    name = 'postgres'
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        # Ответ конкретному сокету этого процесса (история, страницы, upload_ack) уходит напрямую:
+        # через Postgres идут только комнаты и broadcast
+        target = to or room
+        if not kwargs.get('ignore_queue') and isinstance(target, str) and self.is_connected(target, namespace or '/'):
+            kwargs['ignore_queue'] = True
+        return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                            callback=callback, to=to, **kwargs)
+
+    def _publish(self, data):
+        # Только JSON: NOTIFY в этот канал может послать любая роль базы, pickle здесь — исполнение кода
+        payload = json.dumps(data)
+        with db_cursor() as cur:
+            if len(payload) <= NOTIFY_PAYLOAD_LIMIT:
+                cur.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                return
+            cur.execute("INSERT INTO socketio_events (payload) VALUES (%s) RETURNING id", (payload,))
+            cur.execute("SELECT pg_notify(%s, %s)", (self.channel, f"@{cur.fetchone()['id']}"))
+            if random.random() < 0.01:
+                cur.execute("DELETE FROM socketio_events WHERE created_at < NOW() - INTERVAL '5 minutes'")
+
+    def _load(self, conn, payload):
+        if payload.startswith('@'):
+            with conn.cursor() as cur:
+                cur.execute("SELECT payload FROM socketio_events WHERE id = %s", (int(payload[1:]),))
+                row = cur.fetchone()
+            if not row:
+                return None
+            payload = row['payload']
+        message = json.loads(payload)
+        return message if isinstance(message, dict) else None
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = db_pool.connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                while True:
+                    select.select([conn], [], [], 30)
+                    conn.poll()
+                    while conn.notifies:
+                        try:
+                            data = self._load(conn, conn.notifies.pop(0).payload)
+                        except (ValueError, TypeError) as e:
+                            # Битое уведомление пропускаем, слушатель продолжает работу
+                            print(f'❌ Bad broadcast payload: {e}')
+                            continue
+                        if data is not None:
+                            yield data
+            except psycopg2.Error as e:
+                print(f'❌ LISTEN connection lost: {e}')
+                # Пока соединения не было, уведомления терялись — кеш истории мог отстать
+                forget_recent_messages()
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _handle_emit(self, message):
+        # Локальные кеши других воркеров догоняют изменения по тем же событиям, что идут клиентам:
+        # new_message — в свежую историю, favorite_toggled (комната user:<id>) — в избранное,
+        # profile_updated — в кеш профилей
+        data = message.get('data')
+        try:
+            if message.get('namespace', '/') == '/' and isinstance(data, dict):
+                if message.get('event') == 'new_message':
+                    remember_general_message(data)
+                elif message.get('event') == 'profile_updated':
+                    cache_user_profile(data['user_id'], data['username'], data['tag'], data['avatar'])
+                elif message.get('event') == 'favorite_toggled' and str(message.get('room')).startswith('user:'):
+                    user_id = int(message['room'].split(':', 1)[1])
+                    if data.get('chat_id') == 'general':
+                        update_cached_favorite(user_id, message_id=data['message_id'], is_favorite=data['is_favorite'])
+                    else:
+                        update_cached_favorite(user_id, private_message_id=data['message_id'],
+                                               is_favorite=data['is_favorite'])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f'❌ Bad broadcast event {message.get("event")}: {e}')
+        return super()._handle_emit(message)
+
+socketio = SocketIO(
+    app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25,
+    client_manager=PostgresManager() if BROADCAST_BACKEND == 'postgres' else None
+)
+
+def on_event(event):
+    """socketio.on с замером обработчика; лишние аргументы (auth у connect) отбрасываются,
+    если обработчик их не принимает."""
+    def decorator(handler):
+        accepts = len(inspect.signature(handler).parameters)
+        timed = instrumented('event', event)(handler)
+        
+        @functools.wraps(handler)
+        def wrapper(*args):
+            return timed(*args[:accepts])
+        return socketio.on(event)(wrapper)
+    return decorator
 
 # === Функции паролей ===
+class PasswordPoolBusy(Exception):
+    pass
+
+password_slots = threading.Semaphore(PASSWORD_WORKERS)
+password_pending = 0
+
+def run_password_task(func, *args):
+    """bcrypt в потоках tpool: не больше PASSWORD_WORKERS одновременно и PASSWORD_QUEUE_LIMIT в очереди.
+
+    Хеширование идёт в настоящих потоках (bcrypt отпускает GIL), поэтому хаб eventlet
+    продолжает доставлять сообщения; при переполнении очереди — PasswordPoolBusy.
+    """
+    global password_pending
+    if password_pending >= PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT:
+        raise PasswordPoolBusy()
+    password_pending += 1
+    try:
+        with password_slots:
+            return tpool.execute(func, *args)
+    finally:
+        password_pending -= 1
+
 def hash_password(password):
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    hashed = run_password_task(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+    return hashed.decode('utf-8')
 
 def check_password(password, hashed):
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return run_password_task(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
 
 # === Вспомогательные функции ===
 def validate_tag(tag):
@@ -62,99 +594,546 @@ def validate_tag(tag):
 def generate_session_token():
     return hashlib.sha256(secrets.token_bytes(32)).hexdigest()
 
+def hash_session_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def keyset_clause(column, before_id=None, after_id=None):
+    """Условие и порядок для постраничной выборки по id: (sql, 'ASC'|'DESC', params)."""
+    if after_id:
+        return f'{column} > %s', 'ASC', [after_id]
+    if before_id:
+        return f'{column} < %s', 'DESC', [before_id]
+    return 'TRUE', 'DESC', []
+
+def parse_page_request(data):
+    """Достаёт before_id/after_id/limit из запроса клиента, ограничивая размер страницы."""
+    try:
+        before_id = int(data['before_id']) if data.get('before_id') else None
+        after_id = int(data['after_id']) if data.get('after_id') else None
+        limit = int(data.get('limit') or PAGE_SIZE)
+    except (TypeError, ValueError):
+        return None
+    return before_id, after_id, max(1, min(limit, MAX_PAGE_SIZE))
+
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+@instrumented('db')
+def search_users(term, limit=SEARCH_LIMIT):
+    """Пользователи по юзернейму: точное совпадение, затем префикс, затем подстрока.
+
+    Каждая ступень — отдельный запрос по своему индексу с LIMIT, так что на миллионе
+    пользователей ни один не сортирует все совпадения. Подстрока ищется от 3 символов:
+    короче триграммный индекс не помогает.
+    """
+    term = term.lower()
+    pattern = like_escape(term)
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT id, username, user_tag, avatar FROM users
+            WHERE user_tag COLLATE "C" LIKE %s
+            ORDER BY user_tag COLLATE "C"
+            LIMIT %s
+        """, (pattern + '%', limit))
+        found = cur.fetchall()
+        
+        if len(found) < limit and len(term) >= 3:
+            cur.execute("""
+                SELECT id, username, user_tag, avatar FROM users
+                WHERE user_tag LIKE %s AND user_tag NOT LIKE %s
+                LIMIT %s
+            """, ('%' + pattern + '%', pattern + '%', limit - len(found)))
+            found += sorted(cur.fetchall(), key=lambda row: (len(row['user_tag']), row['user_tag']))
+    
+    return found
+
 def generate_chat_id(user1_id, user2_id):
     ids = sorted([user1_id, user2_id])
     return hashlib.sha256(f"{ids[0]}-{ids[1]}".encode()).hexdigest()[:16]
 
+@instrumented('db')
 def get_user_by_id(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, user_tag, avatar FROM users WHERE id = %s", (user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user
+    with db_cursor() as cur:
+        cur.execute("SELECT id, username, user_tag, avatar FROM users WHERE id = %s", (user_id,))
+        return cur.fetchone()
 
-def update_last_seen(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+profile_cache = OrderedDict()  # {user_id: {'user': str, 'tag': str, 'avatar': str}}
 
-# === РАБОТА С ЛИЧНЫМИ ЧАТАМИ ===
-def get_or_create_private_chat(user1_id, user2_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
+@instrumented('db')
+def get_user_profiles(user_ids):
+    """Профили отправителей для истории: из LRU-кеша, недостающие — одним запросом."""
+    profiles = {}
+    missing = []
+    for user_id in set(user_ids):
+        if user_id in profile_cache:
+            profile_cache.move_to_end(user_id)
+            profiles[user_id] = profile_cache[user_id]
+        else:
+            missing.append(user_id)
     
-    cur.execute("""
-        SELECT chat_id FROM private_chats 
-        WHERE (user1_id = %s AND user2_id = %s) OR (user1_id = %s AND user2_id = %s)
-    """, (user1_id, user2_id, user2_id, user1_id))
+    if missing:
+        with db_cursor() as cur:
+            cur.execute("SELECT id, username, user_tag, avatar FROM users WHERE id = ANY(%s)", (missing,))
+            rows = cur.fetchall()
+        for row in rows:
+            profiles[row['id']] = cache_user_profile(row['id'], row['username'], row['user_tag'], row['avatar'])
     
-    existing = cur.fetchone()
-    if existing:
-        cur.close()
-        conn.close()
-        return existing['chat_id']
+    return profiles
+
+def cache_user_profile(user_id, username, tag, avatar):
+    profile = {'user': username, 'tag': tag, 'avatar': avatar}
+    profile_cache[user_id] = profile
+    profile_cache.move_to_end(user_id)
+    while len(profile_cache) > PROFILE_CACHE_SIZE:
+        profile_cache.popitem(last=False)
+    return profile
+
+# === СЕССИИ ===
+session_cache = OrderedDict()  # {token_hash: (user_id, expires_at, cached_until)} — unix time
+
+@instrumented('db')
+def create_session(user_id):
+    """Новая сессия на SESSION_TTL; попутно удаляет истёкшие сессии этого пользователя."""
+    token = generate_session_token()
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM sessions WHERE user_id = %s AND expires_at < NOW()", (user_id,))
+        cur.execute("""
+            INSERT INTO sessions (token_hash, user_id, expires_at)
+            VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+        """, (hash_session_token(token), user_id, SESSION_TTL))
+    return token
+
+@instrumented('db')
+def get_session_user_id(token):
+    """user_id по токену или None. Проверенные токены живут в кеше SESSION_CACHE_TTL секунд.
+
+    Отзыв сессии сбрасывает кеш только в своём процессе — в остальных воркерах
+    токен остаётся действительным не дольше SESSION_CACHE_TTL.
+    """
+    if not token or not isinstance(token, str):
+        return None
+    token_hash = hash_session_token(token)
+    now = time.time()
+    cached = session_cache.get(token_hash)
+    if cached:
+        user_id, expires_at, cached_until = cached
+        if now < cached_until and now < expires_at:
+            session_cache.move_to_end(token_hash)
+            return user_id
+        del session_cache[token_hash]
+    
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT user_id, EXTRACT(EPOCH FROM expires_at - NOW()) AS ttl FROM sessions
+            WHERE token_hash = %s AND expires_at > NOW()
+        """, (token_hash,))
+        row = cur.fetchone()
+    if not row:
+        return None
     
-    chat_id = generate_chat_id(user1_id, user2_id)
+    session_cache[token_hash] = (row['user_id'], now + float(row['ttl']), now + SESSION_CACHE_TTL)
+    while len(session_cache) > SESSION_CACHE_SIZE:
+        session_cache.popitem(last=False)
+    return row['user_id']
+
+@instrumented('db')
+def revoke_session(token):
+    token_hash = hash_session_token(token)
+    session_cache.pop(token_hash, None)
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM sessions WHERE token_hash = %s", (token_hash,))
+
+# === ПРИСУТСТВИЕ ===
+last_seen_buffer = {}  # {user_id: unix time последней активности}
+presence_stats = {'flushes': 0, 'flush_errors': 0, 'last_flush_size': 0, 'last_flush_seconds': 0.0}
+presence_writer_started = False
+
+def update_last_seen(user_id):
+    """Запоминает активность в памяти; в базу она попадает пачкой раз в LAST_SEEN_FLUSH_INTERVAL."""
+    global presence_writer_started
+    last_seen_buffer[user_id] = time.time()
+    if not presence_writer_started:
+        presence_writer_started = True
+        socketio.start_background_task(last_seen_writer)
+
+@instrumented('db')
+def flush_last_seen():
+    if not last_seen_buffer:
+        return 0
+    
+    batch = sorted(last_seen_buffer.items())
+    last_seen_buffer.clear()
+    start = time.monotonic()
     try:
-        cur.execute("""
-            INSERT INTO private_chats (chat_id, user1_id, user2_id)
-            VALUES (%s, %s, %s)
-            RETURNING chat_id
-        """, (chat_id, user1_id, user2_id))
-        new_chat = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
-        return new_chat['chat_id']
+        with db_cursor() as cur:
+            execute_values(cur, '''
+                UPDATE users u SET last_seen = to_timestamp(v.seen)
+                FROM (VALUES %s) AS v(id, seen)
+                WHERE u.id = v.id
+            ''', batch)
     except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
+        # Возвращаем пачку в буфер, не затирая более свежие отметки (PoolTimeout тоже сюда)
+        for user_id, seen in batch:
+            last_seen_buffer[user_id] = max(seen, last_seen_buffer.get(user_id, 0))
+        presence_stats['flush_errors'] += 1
+        print(f'❌ Error flushing last_seen: {e}')
+        return 0
+    
+    presence_stats['flushes'] += 1
+    presence_stats['last_flush_size'] = len(batch)
+    presence_stats['last_flush_seconds'] = time.monotonic() - start
+    return len(batch)
+
+def last_seen_writer():
+    while True:
+        socketio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            flush_last_seen()
+        except Exception as e:
+            # Писатель запускается один раз на процесс — он не должен умирать
+            print(f'❌ last_seen writer error: {e}')
+
+def get_presence_metrics():
+    return {'buffer_size': len(last_seen_buffer), **presence_stats}
+
+atexit.register(flush_last_seen)
+
+# === ИЗОБРАЖЕНИЯ ===
+def webp_mode(img):
+    if img.mode in ('RGB', 'RGBA'):
+        return img
+    return img.convert('RGBA' if 'transparency' in img.info or 'A' in img.getbands() else 'RGB')
+
+def save_webp(img, dst_path):
+    """Сохраняет кадр в WebP через временный файл. EXIF при этом не переносится."""
+    img = webp_mode(img)
+    tmp_path = f'{dst_path}.{secrets.token_hex(4)}.tmp'
+    img.save(tmp_path, 'WEBP', quality=80)
+    os.replace(tmp_path, dst_path)
+
+def make_thumbnail(src_path, dst_path):
+    """Уменьшенная копия вложения. Вызывается через tpool, чтобы не блокировать хаб. Возвращает (w, h) или None."""
+    try:
+        with Image.open(src_path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            save_webp(img, dst_path)
+            return img.size
+    except Exception as e:
+        # Превью необязательно: любой сбой Pillow (битые чанки PNG, EXIF, редкие режимы) — просто без него
+        print(f'❌ Error making thumbnail: {e}')
+        return None
+
+def make_avatar(raw):
+    """Квадратная аватарка AVATAR_SIZE в WebP. Вызывается через tpool. Возвращает байты или None."""
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            img = webp_mode(ImageOps.fit(ImageOps.exif_transpose(img), (AVATAR_SIZE, AVATAR_SIZE)))
+            out = io.BytesIO()
+            img.save(out, 'WEBP', quality=85)
+            return out.getvalue()
+    except Exception as e:
+        print(f'❌ Error making avatar: {e}')
+        return None
+
+# === АВАТАРКИ ===
+def store_avatar(avatar):
+    """Сохраняет аватарку из data URL на диск под хешем содержимого и возвращает короткую ссылку.
+
+    Встроенные аватарки ('default', 'fa-...') и уже сохранённые ссылки возвращаются как есть,
+    для любой другой строки, некорректного или слишком большого data URL возвращается None.
+    """
+    if not isinstance(avatar, str):
+        return None
+    if avatar == 'default' or re.fullmatch(r'fa-[a-z]+( fa-[a-z0-9-]+){0,2}', avatar) \
+            or re.fullmatch(r'/avatars/[0-9a-f]{32}\.webp', avatar):
+        return avatar
+    if not avatar.startswith('data:'):
+        return None
+    
+    header, _, payload = avatar.partition(',')
+    if header[5:].split(';')[0] not in IMAGE_TYPES or not header.endswith(';base64'):
+        return None
+    
+    try:
+        raw = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if not raw or len(raw) > AVATAR_MAX_SIZE:
+        return None
+    
+    raw = tpool.execute(make_avatar, raw)
+    if not raw:
+        return None
+    
+    name = f'{hashlib.sha256(raw).hexdigest()[:32]}.webp'
+    path = os.path.join(app.config['AVATAR_FOLDER'], name)
+    if not os.path.exists(path):
+        tmp_path = f'{path}.{secrets.token_hex(4)}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+    return f'/avatars/{name}'
+
+@app.cli.command('migrate-avatars')
+def migrate_avatars_command():
+    """Переносит data URL аватарки из users и messages в хранилище по хешу."""
+    migrated = 0
+    with db_cursor() as cur:
+        cur.execute("SELECT id, avatar FROM users WHERE avatar LIKE 'data:%'")
+        rows = cur.fetchall()
+    for row in rows:
+        with db_cursor() as cur:
+            cur.execute("UPDATE users SET avatar = %s WHERE id = %s", (store_avatar(row['avatar']) or 'default', row['id']))
+        migrated += 1
+    
+    with db_cursor() as cur:
+        cur.execute("SELECT DISTINCT avatar FROM messages WHERE avatar LIKE 'data:%'")
+        avatars = [r['avatar'] for r in cur.fetchall()]
+    for avatar in avatars:
+        with db_cursor() as cur:
+            cur.execute("UPDATE messages SET avatar = %s WHERE avatar = %s", (store_avatar(avatar) or 'default', avatar))
+            migrated += cur.rowcount
+    
+    print(f'✅ Перенесено аватарок: {migrated}')
+
+# === ХРАНИЛИЩЕ ВЛОЖЕНИЙ ===
+def attachment_path(digest):
+    """uploads/files/ab/cd/abcd… — два уровня каталогов, чтобы не копить файлы в одном."""
+    return os.path.join(app.config['FILES_FOLDER'], digest[:2], digest[2:4], digest)
+
+def thumbnail_path(digest):
+    return f'{attachment_path(digest)}.thumb.webp'
+
+def thumbnail_info(digest, width, height):
+    if not digest or not width:
+        return None
+    return {'url': f'/thumbs/{digest}.webp', 'width': width, 'height': height}
+
+attachment_mime_cache = OrderedDict()  # {sha256: mime_type}
+
+@instrumented('db')
+def get_attachment_mime_type(digest):
+    """MIME-тип вложения из attachments или None. Тип у хеша не меняется, поэтому кеш только вытесняется."""
+    mime_type = attachment_mime_cache.get(digest)
+    if mime_type:
+        attachment_mime_cache.move_to_end(digest)
+        return mime_type
+    
+    with db_cursor() as cur:
+        cur.execute("SELECT mime_type FROM attachments WHERE sha256 = %s", (digest,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    
+    attachment_mime_cache[digest] = row['mime_type']
+    while len(attachment_mime_cache) > ATTACHMENT_CACHE_SIZE:
+        attachment_mime_cache.popitem(last=False)
+    return row['mime_type']
+
+@instrumented('db')
+def store_attachment(src_path, digest, filename, size):
+    """Переносит загруженный файл в хранилище по SHA-256 и увеличивает счётчик ссылок.
+
+    Если такой файл уже есть, новая копия удаляется — одинаковые вложения хранятся один раз.
+    Для изображений один раз строится превью. Возвращает {'sha256', 'url', 'thumbnail'}.
+    """
+    path = attachment_path(digest)
+    if os.path.exists(path):
+        os.remove(src_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+    
+    mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    with db_cursor() as cur:
+        cur.execute('''
+            INSERT INTO attachments (sha256, size, mime_type, original_name, ref_count)
+            VALUES (%s, %s, %s, %s, 1)
+            ON CONFLICT (sha256) DO UPDATE SET ref_count = attachments.ref_count + 1
+            RETURNING mime_type, thumb_width, thumb_height
+        ''', (digest, size, mime_type, filename))
+        row = cur.fetchone()
+    
+    thumbnail = thumbnail_info(digest, row['thumb_width'], row['thumb_height'])
+    if not thumbnail and row['mime_type'] in IMAGE_TYPES:
+        thumb_size = tpool.execute(make_thumbnail, path, thumbnail_path(digest))
+        if thumb_size:
+            with db_cursor() as cur:
+                cur.execute("UPDATE attachments SET thumb_width = %s, thumb_height = %s WHERE sha256 = %s",
+                            (*thumb_size, digest))
+            thumbnail = thumbnail_info(digest, *thumb_size)
+    
+    return {'sha256': digest, 'url': f'/files/{digest}/{filename}', 'thumbnail': thumbnail}
+
+def store_base64_attachment(file_data, filename):
+    """Старый путь send_file: data URL целиком в одном сообщении. Возвращает (filename, attachment)."""
+    if ',' in file_data:
+        file_data = file_data.split(',')[1]
+    raw = base64.b64decode(file_data)
+    
+    filename = secure_filename(filename) or 'file'
+    tmp_path = os.path.join(app.config['PARTIAL_FOLDER'], secrets.token_hex(16))
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+    
+    return filename, store_attachment(tmp_path, hashlib.sha256(raw).hexdigest(), filename, len(raw))
+
+# === РАБОТА С ЛИЧНЫМИ ЧАТАМИ ===
+chat_cache = OrderedDict()  # {(меньший user_id, больший user_id): chat_id}
+chat_members_cache = OrderedDict()  # {chat_id: {'user1_id': int, 'user2_id': int}}
+
+def cache_private_chat(chat_id, user1_id, user2_id):
+    """Участники чата не меняются, поэтому записи кеша не устаревают — только вытесняются."""
+    pair = (min(user1_id, user2_id), max(user1_id, user2_id))
+    chat_cache[pair] = chat_id
+    chat_cache.move_to_end(pair)
+    chat_members_cache[chat_id] = {'user1_id': user1_id, 'user2_id': user2_id}
+    chat_members_cache.move_to_end(chat_id)
+    while len(chat_cache) > CHAT_CACHE_SIZE:
+        chat_cache.popitem(last=False)
+    while len(chat_members_cache) > CHAT_CACHE_SIZE:
+        chat_members_cache.popitem(last=False)
+
+@instrumented('db')
+def get_or_create_private_chat(user1_id, user2_id):
+    """chat_id пары: из кеша без запросов, иначе одной вставкой с ON CONFLICT DO NOTHING.
+
+    Новый чат пишется в каноническом порядке (меньший id первым); уникальный индекс по
+    (LEAST, GREATEST) не даёт двум одновременным открытиям создать две строки.
+    """
+    pair = (min(user1_id, user2_id), max(user1_id, user2_id))
+    chat_id = chat_cache.get(pair)
+    if chat_id:
+        chat_cache.move_to_end(pair)
+        return chat_id
+    
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                WITH created AS (
+                    INSERT INTO private_chats (chat_id, user1_id, user2_id)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING chat_id, user1_id, user2_id
+                )
+                SELECT chat_id, user1_id, user2_id FROM created
+                UNION ALL
+                SELECT chat_id, user1_id, user2_id FROM private_chats
+                WHERE LEAST(user1_id, user2_id) = %s AND GREATEST(user1_id, user2_id) = %s
+                LIMIT 1
+            """, (generate_chat_id(*pair), *pair, *pair))
+            chat = cur.fetchone()
+            
+            if not chat:
+                # Встречная вставка зафиксировалась уже после снимка нашего запроса — перечитываем
+                cur.execute("""
+                    SELECT chat_id, user1_id, user2_id FROM private_chats
+                    WHERE LEAST(user1_id, user2_id) = %s AND GREATEST(user1_id, user2_id) = %s
+                """, pair)
+                chat = cur.fetchone()
+    except psycopg2.Error as e:
         print(f"❌ Error creating private chat: {e}")
         return None
+    
+    if not chat:
+        return None
+    
+    cache_private_chat(chat['chat_id'], chat['user1_id'], chat['user2_id'])
+    return chat['chat_id']
 
-def save_private_message(chat_id, sender_id, receiver_id, msg_type, text=None, filename=None, filepath=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO private_messages (chat_id, sender_id, receiver_id, message_text, filename, filepath, message_type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id, created_at
-    ''', (chat_id, sender_id, receiver_id, text, filename, filepath, msg_type))
-    result = cur.fetchone()
-    conn.commit()
-    cur.close()
-    conn.close()
-    return result
+@instrumented('db')
+def save_private_message(chat_id, sender_id, receiver_id, msg_type, text=None, filename=None, filepath=None,
+                         attachment_sha256=None):
+    with db_cursor() as cur:
+        cur.execute('''
+            INSERT INTO private_messages
+                (chat_id, sender_id, receiver_id, message_text, filename, filepath, message_type, attachment_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, created_at
+        ''', (chat_id, sender_id, receiver_id, text, filename, filepath, msg_type, attachment_sha256))
+        result = cur.fetchone()
+        
+        # Сводка чата обновляется в той же транзакции; при гонке вставок побеждает больший id.
+        # Новое состояние сводки возвращается сразу — из него собирается chat_list_delta
+        preview = (text or filename or '')[:LAST_TEXT_PREVIEW]
+        cur.execute('''
+            WITH summary AS (
+                INSERT INTO private_chat_summary AS s
+                    (chat_id, last_message_id, last_text, last_at, user1_unread, user2_unread)
+                SELECT pc.chat_id, %s, %s, %s,
+                       CASE WHEN pc.user1_id = %s THEN 1 ELSE 0 END,
+                       CASE WHEN pc.user2_id = %s THEN 1 ELSE 0 END
+                FROM private_chats pc
+                WHERE pc.chat_id = %s
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    last_text = CASE WHEN s.last_message_id IS NULL OR EXCLUDED.last_message_id > s.last_message_id
+                                     THEN EXCLUDED.last_text ELSE s.last_text END,
+                    last_at = CASE WHEN s.last_message_id IS NULL OR EXCLUDED.last_message_id > s.last_message_id
+                                   THEN EXCLUDED.last_at ELSE s.last_at END,
+                    last_message_id = GREATEST(s.last_message_id, EXCLUDED.last_message_id),
+                    user1_unread = s.user1_unread + CASE WHEN EXCLUDED.last_message_id > s.user1_last_read_id
+                                                         THEN EXCLUDED.user1_unread ELSE 0 END,
+                    user2_unread = s.user2_unread + CASE WHEN EXCLUDED.last_message_id > s.user2_last_read_id
+                                                         THEN EXCLUDED.user2_unread ELSE 0 END
+                RETURNING s.*
+            )
+            SELECT summary.last_text, summary.last_at,
+                   CASE WHEN pc.user1_id = %s THEN summary.user1_unread ELSE summary.user2_unread END AS receiver_unread,
+                   CASE WHEN pc.user1_id = %s THEN summary.user2_unread ELSE summary.user1_unread END AS sender_unread
+            FROM summary JOIN private_chats pc ON pc.chat_id = summary.chat_id
+        ''', (result['id'], preview, result['created_at'], receiver_id, receiver_id, chat_id, receiver_id, receiver_id))
+        summary = cur.fetchone()
+        if summary:
+            result.update(summary)
+        return result
 
-def get_private_chat_history(chat_id, user_id, limit=100):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT 
-            pm.*, 
-            u_sender.username as sender_name, 
-            u_sender.user_tag as sender_tag, 
-            u_sender.avatar as sender_avatar,
-            u_receiver.username as receiver_name,
-            CASE WHEN f.id IS NOT NULL THEN true ELSE false END as is_favorite
-        FROM private_messages pm
-        JOIN users u_sender ON pm.sender_id = u_sender.id
-        JOIN users u_receiver ON pm.receiver_id = u_receiver.id
-        LEFT JOIN favorites f ON pm.id = f.private_message_id AND f.user_id = %s
-        WHERE pm.chat_id = %s
-        ORDER BY pm.created_at ASC
-        LIMIT %s
-    ''', (user_id, chat_id, limit))
-    messages = cur.fetchall()
-    cur.close()
-    conn.close()
+@instrumented('db')
+def get_private_chat(chat_id):
+    chat = chat_members_cache.get(chat_id)
+    if chat:
+        chat_members_cache.move_to_end(chat_id)
+        return chat
+    
+    with db_cursor() as cur:
+        cur.execute("SELECT user1_id, user2_id FROM private_chats WHERE chat_id = %s", (chat_id,))
+        chat = cur.fetchone()
+    if chat:
+        cache_private_chat(chat_id, chat['user1_id'], chat['user2_id'])
+    return chat
+
+@instrumented('db')
+def get_private_chat_history(chat_id, user_id, limit=100, before_id=None, after_id=None):
+    condition, order, params = keyset_clause('pm.id', before_id, after_id)
+    with db_cursor() as cur:
+        cur.execute(f'''
+            SELECT 
+                pm.id, pm.chat_id, pm.sender_id, pm.receiver_id,
+                pm.message_text, pm.filename, pm.filepath, pm.message_type, pm.created_at,
+                pm.attachment_sha256, a.thumb_width, a.thumb_height,
+                u_sender.username as sender_name, 
+                u_sender.user_tag as sender_tag, 
+                u_sender.avatar as sender_avatar,
+                u_receiver.username as receiver_name,
+                COALESCE(pm.id <= CASE WHEN pm.receiver_id = pc.user1_id
+                                       THEN s.user1_last_read_id ELSE s.user2_last_read_id END,
+                         false) as is_read
+            FROM private_messages pm
+            JOIN private_chats pc ON pc.chat_id = pm.chat_id
+            JOIN users u_sender ON pm.sender_id = u_sender.id
+            JOIN users u_receiver ON pm.receiver_id = u_receiver.id
+            LEFT JOIN private_chat_summary s ON s.chat_id = pm.chat_id
+            LEFT JOIN attachments a ON a.sha256 = pm.attachment_sha256
+            WHERE pm.chat_id = %s AND {condition}
+            ORDER BY pm.id {order}
+            LIMIT %s
+        ''', (chat_id, *params, limit))
+        messages = cur.fetchall()
     
+    if order == 'DESC':
+        messages.reverse()
+    
+    favorites = get_favorite_ids(user_id)[1]
     result = []
     for msg in messages:
         result.append({
@@ -167,214 +1146,234 @@ def get_private_chat_history(chat_id, user_id, limit=100):
             'text': msg['message_text'],
             'filename': msg['filename'],
             'filepath': msg['filepath'],
+            'thumbnail': thumbnail_info(msg['attachment_sha256'], msg['thumb_width'], msg['thumb_height']),
             'type': msg['message_type'],
             'is_read': msg['is_read'],
-            'is_favorite': msg['is_favorite'],
+            'is_favorite': msg['id'] in favorites,
             'time': msg['created_at'].strftime('%H:%M') if msg['created_at'] else ''
         })
     
     return result
 
+@instrumented('db')
 def get_user_chats(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT pc.chat_id, 
-               CASE 
-                   WHEN pc.user1_id = %s THEN u2.username
-                   ELSE u1.username
-               END as other_username,
-               CASE 
-                   WHEN pc.user1_id = %s THEN u2.user_tag
-                   ELSE u1.user_tag
-               END as other_tag,
-               CASE 
-                   WHEN pc.user1_id = %s THEN u2.avatar
-                   ELSE u1.avatar
-               END as other_avatar,
-               (SELECT message_text FROM private_messages 
-                WHERE chat_id = pc.chat_id 
-                ORDER BY created_at DESC LIMIT 1) as last_message,
-               (SELECT created_at FROM private_messages 
-                WHERE chat_id = pc.chat_id 
-                ORDER BY created_at DESC LIMIT 1) as last_message_time,
-               (SELECT COUNT(*) FROM private_messages 
-                WHERE chat_id = pc.chat_id AND receiver_id = %s AND is_read = FALSE) as unread_count
-        FROM private_chats pc
-        JOIN users u1 ON pc.user1_id = u1.id
-        JOIN users u2 ON pc.user2_id = u2.id
-        WHERE pc.user1_id = %s OR pc.user2_id = %s
-        ORDER BY last_message_time DESC NULLS LAST
-    """, (user_id, user_id, user_id, user_id, user_id, user_id))
-    chats = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT pc.chat_id, 
+                   CASE 
+                       WHEN pc.user1_id = %s THEN u2.username
+                       ELSE u1.username
+                   END as other_username,
+                   CASE 
+                       WHEN pc.user1_id = %s THEN u2.user_tag
+                       ELSE u1.user_tag
+                   END as other_tag,
+                   CASE 
+                       WHEN pc.user1_id = %s THEN u2.avatar
+                       ELSE u1.avatar
+                   END as other_avatar,
+                   s.last_text as last_message,
+                   s.last_at as last_message_time,
+                   CASE 
+                       WHEN pc.user1_id = %s THEN COALESCE(s.user1_unread, 0)
+                       ELSE COALESCE(s.user2_unread, 0)
+                   END as unread_count
+            FROM private_chats pc
+            JOIN users u1 ON pc.user1_id = u1.id
+            JOIN users u2 ON pc.user2_id = u2.id
+            LEFT JOIN private_chat_summary s ON s.chat_id = pc.chat_id
+            WHERE pc.user1_id = %s OR pc.user2_id = %s
+            ORDER BY last_message_time DESC NULLS LAST
+        """, (user_id, user_id, user_id, user_id, user_id, user_id))
+        chats = cur.fetchall()
     return chats
 
+@instrumented('db')
 def mark_messages_as_read(chat_id, user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE private_messages 
-        SET is_read = TRUE 
-        WHERE chat_id = %s AND receiver_id = %s AND is_read = FALSE
-    """, (chat_id, user_id))
-    updated = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
+    """Сдвигает отметку прочтения пользователя до последнего сообщения чата — одна строка сводки."""
+    with db_cursor() as cur:
+        cur.execute("""
+            UPDATE private_chat_summary s
+            SET user1_last_read_id = CASE WHEN pc.user1_id = %s THEN COALESCE(s.last_message_id, s.user1_last_read_id)
+                                          ELSE s.user1_last_read_id END,
+                user1_unread = CASE WHEN pc.user1_id = %s THEN 0 ELSE s.user1_unread END,
+                user2_last_read_id = CASE WHEN pc.user2_id = %s THEN COALESCE(s.last_message_id, s.user2_last_read_id)
+                                          ELSE s.user2_last_read_id END,
+                user2_unread = CASE WHEN pc.user2_id = %s THEN 0 ELSE s.user2_unread END
+            FROM private_chats pc
+            WHERE pc.chat_id = s.chat_id AND s.chat_id = %s
+        """, (user_id, user_id, user_id, user_id, chat_id))
+        updated = cur.rowcount
     return updated
 
+@instrumented('db')
 def get_chat_info(chat_id, user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            CASE 
-                WHEN pc.user1_id = %s THEN u2.username
-                ELSE u1.username
-            END as username,
-            CASE 
-                WHEN pc.user1_id = %s THEN u2.user_tag
-                ELSE u1.user_tag
-            END as tag,
-            CASE 
-                WHEN pc.user1_id = %s THEN u2.avatar
-                ELSE u1.avatar
-            END as avatar
-        FROM private_chats pc
-        JOIN users u1 ON pc.user1_id = u1.id
-        JOIN users u2 ON pc.user2_id = u2.id
-        WHERE pc.chat_id = %s
-    """, (user_id, user_id, user_id, chat_id))
-    
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT 
+                CASE 
+                    WHEN pc.user1_id = %s THEN u2.username
+                    ELSE u1.username
+                END as username,
+                CASE 
+                    WHEN pc.user1_id = %s THEN u2.user_tag
+                    ELSE u1.user_tag
+                END as tag,
+                CASE 
+                    WHEN pc.user1_id = %s THEN u2.avatar
+                    ELSE u1.avatar
+                END as avatar
+            FROM private_chats pc
+            JOIN users u1 ON pc.user1_id = u1.id
+            JOIN users u2 ON pc.user2_id = u2.id
+            WHERE pc.chat_id = %s
+        """, (user_id, user_id, user_id, chat_id))
+        
+        result = cur.fetchone()
     return result
 
 # === РАБОТА С ИЗБРАННЫМ ===
+favorites_cache = OrderedDict()  # {user_id: (set id из messages, set id из private_messages)}
+
+@instrumented('db')
+def load_favorite_ids(user_id):
+    with db_cursor() as cur:
+        cur.execute("SELECT message_id, private_message_id FROM favorites WHERE user_id = %s", (user_id,))
+        rows = cur.fetchall()
+    general = {row['message_id'] for row in rows if row['message_id']}
+    private = {row['private_message_id'] for row in rows if row['private_message_id']}
+    return general, private
+
+def get_favorite_ids(user_id):
+    """Избранное пользователя из LRU-кеша: одна выборка при первом обращении вместо JOIN
+    в каждом запросе истории. Пара множеств (общий чат, личные чаты)."""
+    if user_id in favorites_cache:
+        favorites_cache.move_to_end(user_id)
+        return favorites_cache[user_id]
+    
+    favorites = favorites_cache[user_id] = load_favorite_ids(user_id)
+    while len(favorites_cache) > FAVORITES_CACHE_SIZE:
+        favorites_cache.popitem(last=False)
+    return favorites
+
+def update_cached_favorite(user_id, message_id=None, private_message_id=None, is_favorite=True):
+    """Правка кеша после изменения в базе; пользователя без кеша подгрузит следующий запрос."""
+    cached = favorites_cache.get(user_id)
+    if cached is None:
+        return
+    ids, message_id = (cached[0], message_id) if message_id else (cached[1], private_message_id)
+    try:
+        message_id = int(message_id)
+    except (TypeError, ValueError):
+        return
+    if is_favorite:
+        ids.add(message_id)
+    else:
+        ids.discard(message_id)
+
+@instrumented('db')
 def add_to_favorites(user_id, message_id=None, private_message_id=None, chat_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    if not message_id and not private_message_id:
+        return {'success': False, 'error': 'no_message_id'}
+    
     try:
-        if message_id:
-            cur.execute("""
-                INSERT INTO favorites (user_id, message_id, chat_id)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            """, (user_id, message_id, chat_id))
-        elif private_message_id:
-            cur.execute("""
-                INSERT INTO favorites (user_id, private_message_id, chat_id)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            """, (user_id, private_message_id, chat_id))
-        else:
-            return {'success': False, 'error': 'no_message_id'}
-        
-        result = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if message_id:
+                cur.execute("""
+                    INSERT INTO favorites (user_id, message_id, chat_id)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                """, (user_id, message_id, chat_id))
+            else:
+                cur.execute("""
+                    INSERT INTO favorites (user_id, private_message_id, chat_id)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                """, (user_id, private_message_id, chat_id))
+            result = cur.fetchone()
+        update_cached_favorite(user_id, message_id, private_message_id)
         return {'success': True, 'favorite_id': result['id']}
     except UniqueViolation:
-        conn.rollback()
-        cur.close()
-        conn.close()
         return {'success': False, 'error': 'already_favorite'}
     except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
         return {'success': False, 'error': str(e)}
 
+@instrumented('db')
 def remove_from_favorites(user_id, message_id=None, private_message_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    if not message_id and not private_message_id:
+        return False
+    
     try:
-        if message_id:
-            cur.execute("DELETE FROM favorites WHERE user_id = %s AND message_id = %s", (user_id, message_id))
-        elif private_message_id:
-            cur.execute("DELETE FROM favorites WHERE user_id = %s AND private_message_id = %s", (user_id, private_message_id))
-        else:
-            cur.close()
-            conn.close()
-            return False
-        
-        deleted = cur.rowcount
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if message_id:
+                cur.execute("DELETE FROM favorites WHERE user_id = %s AND message_id = %s", (user_id, message_id))
+            else:
+                cur.execute("DELETE FROM favorites WHERE user_id = %s AND private_message_id = %s", (user_id, private_message_id))
+            deleted = cur.rowcount
+        update_cached_favorite(user_id, message_id, private_message_id, is_favorite=False)
         return deleted > 0
     except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
         print(f"Error removing favorite: {e}")
         return False
 
+@instrumented('db')
 def get_favorites(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT 
-            'general' as chat_type,
-            f.id as favorite_id,
-            f.added_at,
-            m.id as message_id,
-            m.username as sender_name,
-            m.user_tag as sender_tag,
-            m.avatar as sender_avatar,
-            m.message_text,
-            m.filename,
-            m.filepath,
-            m.message_type,
-            m.created_at
-        FROM favorites f
-        JOIN messages m ON f.message_id = m.id
-        WHERE f.user_id = %s AND f.message_id IS NOT NULL
-        ORDER BY f.added_at DESC
-    """, (user_id,))
-    general_favs = cur.fetchall()
-    
-    cur.execute("""
-        SELECT 
-            'private' as chat_type,
-            f.id as favorite_id,
-            f.added_at,
-            f.chat_id,
-            pm.id as message_id,
-            u_sender.username as sender_name,
-            u_sender.user_tag as sender_tag,
-            u_sender.avatar as sender_avatar,
-            pm.message_text,
-            pm.filename,
-            pm.filepath,
-            pm.message_type,
-            pm.created_at,
-            CASE 
-                WHEN pc.user1_id = %s THEN u2.username
-                ELSE u1.username
-            END as chat_with_name,
-            CASE 
-                WHEN pc.user1_id = %s THEN u2.user_tag
-                ELSE u1.user_tag
-            END as chat_with_tag
-        FROM favorites f
-        JOIN private_messages pm ON f.private_message_id = pm.id
-        JOIN private_chats pc ON f.chat_id = pc.chat_id
-        JOIN users u_sender ON pm.sender_id = u_sender.id
-        JOIN users u1 ON pc.user1_id = u1.id
-        JOIN users u2 ON pc.user2_id = u2.id
-        WHERE f.user_id = %s AND f.private_message_id IS NOT NULL
-        ORDER BY f.added_at DESC
-    """, (user_id, user_id, user_id))
-    private_favs = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT 
+                'general' as chat_type,
+                f.id as favorite_id,
+                f.added_at,
+                m.id as message_id,
+                COALESCE(u.username, m.username) as sender_name,
+                COALESCE(u.user_tag, m.user_tag) as sender_tag,
+                COALESCE(u.avatar, m.avatar) as sender_avatar,
+                m.message_text,
+                m.filename,
+                m.filepath,
+                m.message_type,
+                m.created_at
+            FROM favorites f
+            JOIN messages m ON f.message_id = m.id
+            LEFT JOIN users u ON m.user_id = u.id
+            WHERE f.user_id = %s AND f.message_id IS NOT NULL
+            ORDER BY f.added_at DESC
+        """, (user_id,))
+        general_favs = cur.fetchall()
+        
+        cur.execute("""
+            SELECT 
+                'private' as chat_type,
+                f.id as favorite_id,
+                f.added_at,
+                f.chat_id,
+                pm.id as message_id,
+                u_sender.username as sender_name,
+                u_sender.user_tag as sender_tag,
+                u_sender.avatar as sender_avatar,
+                pm.message_text,
+                pm.filename,
+                pm.filepath,
+                pm.message_type,
+                pm.created_at,
+                CASE 
+                    WHEN pc.user1_id = %s THEN u2.username
+                    ELSE u1.username
+                END as chat_with_name,
+                CASE 
+                    WHEN pc.user1_id = %s THEN u2.user_tag
+                    ELSE u1.user_tag
+                END as chat_with_tag
+            FROM favorites f
+            JOIN private_messages pm ON f.private_message_id = pm.id
+            JOIN private_chats pc ON f.chat_id = pc.chat_id
+            JOIN users u_sender ON pm.sender_id = u_sender.id
+            JOIN users u1 ON pc.user1_id = u1.id
+            JOIN users u2 ON pc.user2_id = u2.id
+            WHERE f.user_id = %s AND f.private_message_id IS NOT NULL
+            ORDER BY f.added_at DESC
+        """, (user_id, user_id, user_id))
+        private_favs = cur.fetchall()
     
     all_favorites = []
     
@@ -412,67 +1411,286 @@ def get_favorites(user_id):
     return all_favorites
 
 # === РАБОТА С ОБЩИМ ЧАТОМ ===
-def save_message(user_id, username, user_tag, avatar, msg_type, text=None, filename=None, filepath=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO messages (user_id, username, user_tag, avatar, message_text, filename, filepath, message_type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    ''', (user_id, username, user_tag, avatar, text, filename, filepath, msg_type))
-    msg_id = cur.fetchone()['id']
-    conn.commit()
-    cur.close()
-    conn.close()
+@instrumented('db')
+def save_message(user_id, msg_type, text=None, filename=None, filepath=None, attachment_sha256=None):
+    with db_cursor() as cur:
+        cur.execute('''
+            INSERT INTO messages (user_id, message_text, filename, filepath, message_type, attachment_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (user_id, text, filename, filepath, msg_type, attachment_sha256))
+        msg_id = cur.fetchone()['id']
     return msg_id
 
-def get_message_history(user_id=None, limit=100):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    if user_id:
-        cur.execute('''
+@instrumented('db')
+def get_message_history(user_id=None, limit=100, before_id=None, after_id=None):
+    condition, order, params = keyset_clause('m.id', before_id, after_id)
+    with db_cursor() as cur:
+        cur.execute(f'''
             SELECT 
-                m.id, m.username, m.user_tag, m.avatar, m.message_text, 
+                m.id, m.user_id, m.username, m.user_tag, m.avatar, m.message_text, 
                 m.filename, m.filepath, m.message_type,
-                TO_CHAR(m.created_at, 'HH24:MI') as formatted_time,
-                CASE WHEN f.id IS NOT NULL THEN true ELSE false END as is_favorite
+                m.attachment_sha256, a.thumb_width, a.thumb_height,
+                TO_CHAR(m.created_at, 'HH24:MI') as formatted_time
             FROM messages m
-            LEFT JOIN favorites f ON m.id = f.message_id AND f.user_id = %s
-            ORDER BY m.created_at ASC
+            LEFT JOIN attachments a ON a.sha256 = m.attachment_sha256
+            WHERE {condition}
+            ORDER BY m.id {order}
             LIMIT %s
-        ''', (user_id, limit))
+        ''', (*params, limit))
+        rows = cur.fetchall()
+    
+    if order == 'DESC':
+        rows.reverse()
+    
+    favorites = get_favorite_ids(user_id)[0] if user_id else set()
+    result = []
+    for r in rows:
+        msg = {
+            'id': r['id'],
+            'user_id': r['user_id'],
+            'text': r['message_text'],
+            'filename': r['filename'],
+            'filepath': r['filepath'],
+            'thumbnail': thumbnail_info(r['attachment_sha256'], r['thumb_width'], r['thumb_height']),
+            'type': r['message_type'],
+            'time': r['formatted_time'],
+            'is_favorite': r['id'] in favorites
+        }
+        if r['user_id'] is None:
+            # Старые строки без user_id хранят профиль отправителя в самой записи
+            msg.update({'user': r['username'], 'tag': r['user_tag'], 'avatar': r['avatar']})
+        result.append(msg)
+    
+    return result
+
+def with_profiles(messages):
+    """Упаковывает историю общего чата вместе с картой профилей отправителей."""
+    user_ids = [msg['user_id'] for msg in messages if msg['user_id'] is not None]
+    return {
+        'messages': messages,
+        'users': get_user_profiles(user_ids)
+    }
+
+recent_messages = []  # последние RECENT_HISTORY_SIZE сообщений общего чата по возрастанию id, без is_favorite
+recent_ids = set()
+recent_loaded = False
+recent_fill_lock = threading.Lock()  # первое заполнение одно на процесс, остальные ждут его
+HISTORY_FIELDS = ('id', 'user_id', 'text', 'filename', 'filepath', 'thumbnail', 'type', 'time')
+
+def remember_general_message(msg):
+    """Кладёт сообщение в кольцевой буфер. Повторы (своё же сообщение, вернувшееся через
+    рассылку между воркерами) отбрасываются, опоздавшие встают на место по id."""
+    if msg.get('id') is None or msg['id'] in recent_ids:
+        return
+    entry = {field: msg.get(field) for field in HISTORY_FIELDS}
+    if msg.get('user_id') is None:
+        entry.update({'user': msg.get('user'), 'tag': msg.get('tag'), 'avatar': msg.get('avatar')})
+    
+    if recent_messages and entry['id'] < recent_messages[-1]['id']:
+        if entry['id'] < recent_messages[0]['id'] and len(recent_messages) >= RECENT_HISTORY_SIZE:
+            return
+        position = bisect.bisect_left([m['id'] for m in recent_messages], entry['id'])
+        recent_messages.insert(position, entry)
     else:
-        cur.execute('''
-            SELECT id, username, user_tag, avatar, message_text, filename, filepath, message_type,
-                   TO_CHAR(created_at, 'HH24:MI') as formatted_time,
-                   false as is_favorite
-            FROM messages 
-            ORDER BY created_at ASC
-            LIMIT %s
-        ''', (limit,))
+        recent_messages.append(entry)
+    recent_ids.add(entry['id'])
     
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    while len(recent_messages) > RECENT_HISTORY_SIZE:
+        recent_ids.discard(recent_messages.pop(0)['id'])
+
+def forget_recent_messages():
+    global recent_loaded
+    recent_loaded = False
+    recent_messages.clear()
+    recent_ids.clear()
+
+def get_recent_history(user_id, limit):
+    """Последние limit сообщений общего чата из памяти с отметками избранного пользователя.
+
+    Буфер заполняется при первом обращении и дальше пополняется отправкой сообщений;
+    запросы, пришедшие во время заполнения, ждут его, а при ошибке следующий запрос
+    пробует снова. None — если столько в буфер не помещается и нужно идти в базу.
+    """
+    global recent_loaded
+    if limit > RECENT_HISTORY_SIZE:
+        return None
+    if not recent_loaded:
+        with recent_fill_lock:
+            if not recent_loaded:
+                rows = get_message_history(None, limit=RECENT_HISTORY_SIZE)
+                for msg in rows:
+                    remember_general_message(msg)
+                recent_loaded = True
+    
+    page = recent_messages[-limit:]
+    favorites = get_favorite_ids(user_id)[0] if user_id else set()
+    return [{**msg, 'is_favorite': msg['id'] in favorites} for msg in page]
+
+@app.cli.command('normalize-messages')
+def normalize_messages_command():
+    """Проставляет user_id старым сообщениям общего чата и удаляет скопированные профили."""
+    with db_cursor() as cur:
+        cur.execute('''
+            UPDATE messages m SET user_id = u.id
+            FROM users u
+            WHERE m.user_id IS NULL AND m.user_tag = u.user_tag
+        ''')
+        print(f'🔗 Привязано к пользователям: {cur.rowcount}')
+    
+    cleared = 0
+    while True:
+        with db_cursor() as cur:
+            cur.execute('''
+                UPDATE messages SET username = NULL, user_tag = NULL, avatar = NULL
+                WHERE id IN (
+                    SELECT id FROM messages
+                    WHERE user_id IS NOT NULL
+                      AND (username IS NOT NULL OR user_tag IS NOT NULL OR avatar IS NOT NULL)
+                    LIMIT %s
+                )
+            ''', (NORMALIZE_BATCH_SIZE,))
+            updated = cur.rowcount
+        if not updated:
+            break
+        cleared += updated
+        print(f'🧹 Очищено строк: {cleared}')
+    
+    print('✅ Сообщения нормализованы')
+
+# === ПОИСК ПО СООБЩЕНИЯМ ===
+SNIPPET_START, SNIPPET_STOP = '\x02', '\x03'
+
+def encode_search_cursor(row):
+    return f"{row['created_at'].isoformat()}|{row['kind']}|{row['id']}"
+
+def decode_search_cursor(cursor):
+    """(created_at, kind, id) из курсора или None, если курсор битый."""
+    try:
+        created_at, kind, message_id = cursor.split('|')
+        return datetime.fromisoformat(created_at), int(kind), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+def snippet_html(snippet):
+    """ts_headline работает с сырым текстом: экранируем его и только потом ставим <mark>."""
+    return (html.escape(snippet)
+            .replace(SNIPPET_START, '<mark>')
+            .replace(SNIPPET_STOP, '</mark>'))
+
+@instrumented('db')
+def search_messages(user_id, query, limit=PAGE_SIZE, before=None):
+    """Совпадения в общем чате и в личных чатах пользователя, от новых к старым.
+
+    Две ветки (kind 0 — общий чат, kind 1 — личные) идут по GIN-индексам search_vector
+    и склеиваются по (created_at, kind, id) — это же ключ курсора before.
+    Фрагменты ts_headline считаются только для строк, попавших в страницу.
+    """
+    condition = '(created_at, kind, id) < (%s, %s, %s)' if before else 'TRUE'
+    with db_cursor() as cur:
+        cur.execute(f"""
+            WITH q AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS query),
+            found AS (
+                SELECT 0 AS kind, 'general' AS chat_id, m.id, m.user_id,
+                       m.username, m.user_tag, m.avatar, m.message_text, m.created_at
+                FROM messages m, q
+                WHERE m.search_vector @@ q.query
+                UNION ALL
+                SELECT 1, pm.chat_id, pm.id, pm.sender_id,
+                       NULL, NULL, NULL, pm.message_text, pm.created_at
+                FROM private_messages pm
+                JOIN private_chats pc ON pc.chat_id = pm.chat_id, q
+                WHERE pm.search_vector @@ q.query AND (pc.user1_id = %s OR pc.user2_id = %s)
+            ),
+            page AS (
+                SELECT * FROM found
+                WHERE {condition}
+                ORDER BY created_at DESC, kind DESC, id DESC
+                LIMIT %s
+            )
+            SELECT page.*, TO_CHAR(page.created_at, 'DD.MM.YYYY HH24:MI') AS formatted_time,
+                   ts_headline('{SEARCH_CONFIG}', page.message_text, q.query,
+                               'StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords=20, MinWords=5, MaxFragments=2') AS snippet
+            FROM page, q
+            ORDER BY page.created_at DESC, page.kind DESC, page.id DESC
+        """, (query, user_id, user_id, *(before or ()), limit))
+        rows = cur.fetchall()
+    
+    results = []
+    for r in rows:
+        msg = {
+            'id': r['id'],
+            'chat_id': r['chat_id'],
+            'user_id': r['user_id'],
+            'snippet': snippet_html(r['snippet']),
+            'time': r['formatted_time'],
+            'cursor': encode_search_cursor(r)
+        }
+        if r['user_id'] is None:
+            msg.update({'user': r['username'], 'tag': r['user_tag'], 'avatar': r['avatar']})
+        results.append(msg)
     
-    return [{
-        'id': r['id'],
-        'user': r['username'],
-        'tag': r['user_tag'],
-        'avatar': r['avatar'],
-        'text': r['message_text'],
-        'filename': r['filename'],
-        'filepath': r['filepath'],
-        'type': r['message_type'],
-        'time': r['formatted_time'],
-        'is_favorite': r['is_favorite']
-    } for r in rows]
+    return results
 
 # === СОКЕТЫ ===
 users = {}  # {socket_id: {'id': user_id, 'username': str, 'tag': str, 'avatar': str}}
-rooms = {}  # {chat_id: [socket_id1, socket_id2]}
+rooms = {}  # {chat_id: {socket_id1, socket_id2}}
+socket_rooms = {}  # {socket_id: {chat_id1, chat_id2}} — обратный индекс для быстрого отключения
+connected_sockets = set()
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['AVATAR_FOLDER'], exist_ok=True)
+os.makedirs(app.config['PARTIAL_FOLDER'], exist_ok=True)
+
+def user_room(user_id):
+    """Комната всех сокетов пользователя (вкладки, устройства) — адрес для личных событий."""
+    return f'user:{user_id}'
+
+def private_message_rooms(chat_id, sender_id, receiver_id):
+    """Личное сообщение: открытый чат плюс все сокеты обоих участников (для превью и счётчиков)."""
+    return [chat_id, user_room(sender_id), user_room(receiver_id)]
+
+def join_chat_room(chat_id):
+    join_room(chat_id)
+    rooms.setdefault(chat_id, set()).add(request.sid)
+    socket_rooms.setdefault(request.sid, set()).add(chat_id)
+
+def leave_chat_room(chat_id):
+    leave_room(chat_id)
+    forget_room_member(chat_id, request.sid)
+    sid_rooms = socket_rooms.get(request.sid)
+    if sid_rooms is not None:
+        sid_rooms.discard(chat_id)
+        if not sid_rooms:
+            del socket_rooms[request.sid]
+
+def forget_room_member(chat_id, sid):
+    members = rooms.get(chat_id)
+    if members is not None:
+        members.discard(sid)
+        if not members:
+            del rooms[chat_id]
+
+@app.route('/stats')
+def stats():
+    return {'db_pool': db_pool.stats(), 'presence': get_presence_metrics()}
+
+@app.route('/metrics')
+def metrics():
+    pool = db_pool.stats()
+    lines = prometheus_histograms('messka_event', 'event', 'event')
+    lines += prometheus_histograms('messka_db', 'db', 'query')
+    lines += prometheus_gauges({
+        'messka_connected_sockets': ('Open Socket.IO connections', len(connected_sockets)),
+        'messka_authenticated_sockets': ('Connections bound to a user', len(users)),
+        'messka_rooms': ('Private chat rooms with listeners', len(rooms)),
+        'messka_room_members': ('Socket memberships across rooms', sum(len(sids) for sids in rooms.values())),
+        'messka_db_pool_size': ('Open database connections', pool['size']),
+        'messka_db_pool_idle': ('Idle database connections', pool['idle']),
+        'messka_db_pool_max': ('Database pool limit', pool['max']),
+        'messka_last_seen_buffer': ('Pending last_seen updates', len(last_seen_buffer)),
+        'messka_password_pending': ('bcrypt tasks running or queued', password_pending),
+    })
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -482,29 +1700,27 @@ def index():
 def chat_page():
     return render_template('chat.html')
 
-@socketio.on('connect')
+@on_event('connect')
 def handle_connect():
+    connected_sockets.add(request.sid)
     print(f'✅ Client connected: {request.sid}')
 
-@socketio.on('disconnect')
+@on_event('disconnect')
 def handle_disconnect():
+    connected_sockets.discard(request.sid)
+    for chat_id in socket_rooms.pop(request.sid, ()):
+        forget_room_member(chat_id, request.sid)
+    
     user_data = users.pop(request.sid, None)
     if user_data:
-        for room in list(rooms.keys()):
-            if request.sid in rooms[room]:
-                rooms[room].remove(request.sid)
-                if len(rooms[room]) == 0:
-                    del rooms[room]
-        
         emit('user_left', user_data['username'], broadcast=True)
         print(f'👋 User left: {user_data["username"]}')
 
-@socketio.on('register')
+@on_event('register')
 def handle_register(data):
     username = data.get('username')
     user_tag = data.get('tag')
     password = data.get('password')
-    avatar = data.get('avatar', 'default')
     
     if not username or not user_tag or not password:
         emit('register_error', {'error': 'Заполните все поля'})
@@ -514,29 +1730,42 @@ def handle_register(data):
         emit('register_error', {'error': 'Некорректный юзернейм (только латиница, цифры, _, 3-20 символов)'})
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE username = %s OR user_tag = %s", (username, user_tag))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT id FROM users WHERE username = %s OR user_tag = %s", (username, user_tag))
+        exists = cur.fetchone()
+    if exists:
         emit('register_error', {'error': 'Пользователь уже существует'})
         return
     
-    password_hash = hash_password(password)
-    cur.execute("""
-        INSERT INTO users (username, user_tag, password_hash, avatar)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id, username, user_tag, avatar
-    """, (username, user_tag, password_hash, avatar))
-    user = cur.fetchone()
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        password_hash = hash_password(password)
+    except PasswordPoolBusy:
+        emit('register_error', {'error': 'Сервер занят, повторите попытку', 'retry': True})
+        return
+    
+    # Декодирование и запись аватарки — только для запроса, прошедшего все проверки
+    avatar = store_avatar(data.get('avatar', 'default'))
+    if not avatar:
+        emit('register_error', {'error': 'Некорректная аватарка'})
+        return
+    
+    with db_cursor() as cur:
+        cur.execute("""
+            INSERT INTO users (username, user_tag, password_hash, avatar)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id, username, user_tag, avatar
+        """, (username, user_tag, password_hash, avatar))
+        user = cur.fetchone()
     
-    emit('register_success', {'user': user})
+    emit('register_success', {'user': {
+        'id': user['id'],
+        'username': user['username'],
+        'tag': user['user_tag'],
+        'avatar': user['avatar'],
+        'token': create_session(user['id'])
+    }})
 
-@socketio.on('login')
+@on_event('login')
 def handle_login(data):
     username = data.get('username')
     password = data.get('password')
@@ -545,14 +1774,17 @@ def handle_login(data):
         emit('login_error', {'error': 'Заполните все поля'})
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, user_tag, avatar, password_hash FROM users WHERE username = %s", (username,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT id, username, user_tag, avatar, password_hash FROM users WHERE username = %s", (username,))
+        user = cur.fetchone()
+    
+    try:
+        valid = user is not None and check_password(password, user['password_hash'])
+    except PasswordPoolBusy:
+        emit('login_error', {'error': 'Сервер занят, повторите попытку', 'retry': True})
+        return
     
-    if not user or not check_password(password, user['password_hash']):
+    if not valid:
         emit('login_error', {'error': 'Неверное имя или пароль'})
         return
     
@@ -560,41 +1792,70 @@ def handle_login(data):
         'id': user['id'],
         'username': user['username'],
         'tag': user['user_tag'],
-        'avatar': user['avatar']
+        'avatar': user['avatar'],
+        'token': create_session(user['id'])
     }})
 
-@socketio.on('set_user')
+@on_event('check_session')
+def handle_check_session(data):
+    """Вход по токену из localStorage: поиск по хешу вместо bcrypt при каждом переподключении."""
+    token = (data or {}).get('session_token')
+    user_id = get_session_user_id(token)
+    profile = get_user_profiles([user_id]).get(user_id) if user_id else None
+    if not profile:
+        emit('session_result', {'has_session': False})
+        return
+    
+    attach_user(user_id, profile['user'], profile['tag'], profile['avatar'])
+    emit('session_result', {'has_session': True, 'user': {
+        'id': user_id,
+        'username': profile['user'],
+        'tag': profile['tag'],
+        'avatar': profile['avatar'],
+        'token': token
+    }})
+
+@on_event('logout')
+def handle_logout(data):
+    token = (data or {}).get('session_token')
+    if token and isinstance(token, str):
+        revoke_session(token)
+    user_data = users.pop(request.sid, None)
+    if user_data:
+        leave_room(user_room(user_data['id']))
+
+@on_event('set_user')
 def handle_set_user(data):
+    # user_id от клиента подтверждается токеном сессии: иначе любой мог бы войти в чужую комнату user:<id>
     user_id = data.get('user_id')
-    if not user_id:
+    if not user_id or get_session_user_id(data.get('session_token')) != user_id:
         return
     
     user = get_user_by_id(user_id)
     if user:
-        users[request.sid] = {
-            'id': user['id'],
-            'username': user['username'],
-            'tag': user['user_tag'],
-            'avatar': user['avatar']
-        }
-        
-        emit('user_joined', {
-            'username': user['username'],
-            'tag': user['user_tag'],
-            'avatar': user['avatar']
-        }, broadcast=True)
-        
-        emit('message_history', get_message_history(user['id']))
-        socketio.emit('private_chats_list', get_user_chats(user['id']))
+        attach_user(user['id'], user['username'], user['user_tag'], user['avatar'])
+        emit('private_chats_list', chat_list_payload(get_user_chats(user['id'])))
 
-@socketio.on('get_private_chats')
-def handle_get_private_chats():
-    user_data = users.get(request.sid)
-    if not user_data:
-        return
+def attach_user(user_id, username, tag, avatar):
+    """Привязывает пользователя к текущему сокету и отдаёт ему историю общего чата."""
+    users[request.sid] = {
+        'id': user_id,
+        'username': username,
+        'tag': tag,
+        'avatar': avatar
+    }
+    join_room(user_room(user_id))
+    
+    emit('user_joined', {
+        'username': username,
+        'tag': tag,
+        'avatar': avatar
+    }, broadcast=True)
     
-    chats = get_user_chats(user_data['id'])
-    emit('private_chats_list', [{
+    emit('message_history', with_profiles(get_recent_history(user_id, 100)))
+
+def chat_list_payload(chats):
+    return [{
         'chat_id': chat['chat_id'],
         'username': chat['other_username'],
         'tag': chat['other_tag'],
@@ -602,9 +1863,48 @@ def handle_get_private_chats():
         'last_message': chat['last_message'],
         'last_message_time': chat['last_message_time'].strftime('%H:%M') if chat['last_message_time'] else '',
         'unread_count': chat['unread_count']
-    } for chat in chats])
+    } for chat in chats]
+
+def push_chat_list_delta(chat_id, sender, receiver_id, saved):
+    """Изменившаяся строка списка чатов обоим участникам — вместо повторного get_user_chats.
 
-@socketio.on('start_private_chat')
+    Строка для каждого своя: профиль собеседника и собственный счётчик непрочитанных.
+    """
+    if 'last_text' not in saved:
+        return
+    receiver = get_user_profiles([receiver_id]).get(receiver_id)
+    if not receiver:
+        return
+    
+    row = {
+        'chat_id': chat_id,
+        'last_message': saved['last_text'],
+        'last_message_time': saved['last_at'].strftime('%H:%M') if saved['last_at'] else ''
+    }
+    socketio.emit('chat_list_delta', {
+        **row,
+        'username': sender['username'],
+        'tag': sender['tag'],
+        'avatar': sender['avatar'],
+        'unread_count': saved['receiver_unread']
+    }, room=user_room(receiver_id))
+    socketio.emit('chat_list_delta', {
+        **row,
+        'username': receiver['user'],
+        'tag': receiver['tag'],
+        'avatar': receiver['avatar'],
+        'unread_count': saved['sender_unread']
+    }, room=user_room(sender['id']))
+
+@on_event('get_private_chats')
+def handle_get_private_chats():
+    user_data = users.get(request.sid)
+    if not user_data:
+        return
+    
+    emit('private_chats_list', chat_list_payload(get_user_chats(user_data['id'])))
+
+@on_event('start_private_chat')
 def handle_start_private_chat(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -615,12 +1915,9 @@ def handle_start_private_chat(data):
         emit('private_chat_error', {'error': 'empty_tag'})
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, user_tag, avatar FROM users WHERE user_tag = %s", (target_tag,))
-    target_user = cur.fetchone()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT id, username, user_tag, avatar FROM users WHERE user_tag = %s", (target_tag,))
+        target_user = cur.fetchone()
     
     if not target_user:
         emit('private_chat_error', {'error': 'user_not_found', 'message': 'Пользователь не найден'})
@@ -636,10 +1933,7 @@ def handle_start_private_chat(data):
         emit('private_chat_error', {'error': 'chat_creation_failed'})
         return
     
-    join_room(chat_id)
-    if chat_id not in rooms:
-        rooms[chat_id] = []
-    rooms[chat_id].append(request.sid)
+    join_chat_room(chat_id)
     
     history = get_private_chat_history(chat_id, user_data['id'])
     
@@ -654,7 +1948,62 @@ def handle_start_private_chat(data):
         'history': history
     })
 
-@socketio.on('send_message')
+def post_general_file(user_data, filename, attachment):
+    msg_id = save_message(
+        user_id=user_data['id'],
+        msg_type='file',
+        filename=filename,
+        filepath=attachment['url'],
+        attachment_sha256=attachment['sha256']
+    )
+    
+    message = {
+        'id': msg_id,
+        'user_id': user_data['id'],
+        'user': user_data['username'],
+        'tag': user_data['tag'],
+        'avatar': user_data['avatar'],
+        'filename': filename,
+        'filepath': attachment['url'],
+        'thumbnail': attachment['thumbnail'],
+        'type': 'file',
+        'is_favorite': False,
+        'time': datetime.now().strftime('%H:%M')
+    }
+    remember_general_message(message)
+    emit('new_message', message, broadcast=True)
+
+def post_private_file(user_data, chat_id, receiver_id, filename, attachment):
+    saved = save_private_message(
+        chat_id=chat_id,
+        sender_id=user_data['id'],
+        receiver_id=receiver_id,
+        msg_type='file',
+        filename=filename,
+        filepath=attachment['url'],
+        attachment_sha256=attachment['sha256']
+    )
+    
+    if not saved:
+        return
+    
+    emit('new_private_message', {
+        'id': saved['id'],
+        'chat_id': chat_id,
+        'sender_id': user_data['id'],
+        'sender_name': user_data['username'],
+        'sender_tag': user_data['tag'],
+        'sender_avatar': user_data['avatar'],
+        'filename': filename,
+        'filepath': attachment['url'],
+        'thumbnail': attachment['thumbnail'],
+        'type': 'file',
+        'is_favorite': False,
+        'time': saved['created_at'].strftime('%H:%M')
+    }, room=private_message_rooms(chat_id, user_data['id'], receiver_id))
+    push_chat_list_delta(chat_id, user_data, receiver_id, saved)
+
+@on_event('send_message')
 def handle_message(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -668,15 +2017,13 @@ def handle_message(data):
     
     msg_id = save_message(
         user_id=user_data['id'],
-        username=user_data['username'],
-        user_tag=user_data['tag'],
-        avatar=user_data['avatar'],
         msg_type='text',
         text=message
     )
     
-    emit('new_message', {
+    new_message = {
         'id': msg_id,
+        'user_id': user_data['id'],
         'user': user_data['username'],
         'tag': user_data['tag'],
         'avatar': user_data['avatar'],
@@ -684,9 +2031,11 @@ def handle_message(data):
         'type': 'text',
         'is_favorite': False,
         'time': datetime.now().strftime('%H:%M')
-    }, broadcast=True)
+    }
+    remember_general_message(new_message)
+    emit('new_message', new_message, broadcast=True)
 
-@socketio.on('send_file')
+@on_event('send_file')
 def handle_file(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -701,42 +2050,14 @@ def handle_file(data):
     update_last_seen(user_data['id'])
     
     try:
-        if ',' in file_data:
-            file_data = file_data.split(',')[1]
-        
-        filename = secure_filename(filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        with open(filepath, 'wb') as f:
-            f.write(base64.b64decode(file_data))
-        
-        msg_id = save_message(
-            user_id=user_data['id'],
-            username=user_data['username'],
-            user_tag=user_data['tag'],
-            avatar=user_data['avatar'],
-            msg_type='file',
-            filename=filename,
-            filepath=f'/uploads/{filename}'
-        )
-        
-        emit('new_message', {
-            'id': msg_id,
-            'user': user_data['username'],
-            'tag': user_data['tag'],
-            'avatar': user_data['avatar'],
-            'filename': filename,
-            'filepath': f'/uploads/{filename}',
-            'type': 'file',
-            'is_favorite': False,
-            'time': datetime.now().strftime('%H:%M')
-        }, broadcast=True)
+        filename, attachment = store_base64_attachment(file_data, filename)
+        post_general_file(user_data, filename, attachment)
         
     except Exception as e:
         print(f'❌ Error sending file: {e}')
         emit('file_error', {'error': 'Ошибка при отправке файла'})
 
-@socketio.on('send_private_message')
+@on_event('send_private_message')
 def handle_send_private_message(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -748,13 +2069,7 @@ def handle_send_private_message(data):
     if not chat_id or not message:
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user1_id, user2_id FROM private_chats WHERE chat_id = %s", (chat_id,))
-    chat = cur.fetchone()
-    cur.close()
-    conn.close()
-    
+    chat = get_private_chat(chat_id)
     if not chat:
         return
     
@@ -782,9 +2097,10 @@ def handle_send_private_message(data):
         'type': 'text',
         'is_favorite': False,
         'time': saved['created_at'].strftime('%H:%M')
-    }, room=chat_id)
+    }, room=private_message_rooms(chat_id, user_data['id'], receiver_id))
+    push_chat_list_delta(chat_id, user_data, receiver_id, saved)
 
-@socketio.on('send_private_file')
+@on_event('send_private_file')
 def handle_send_private_file(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -797,59 +2113,221 @@ def handle_send_private_file(data):
     if not chat_id or not filename or not file_data:
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user1_id, user2_id FROM private_chats WHERE chat_id = %s", (chat_id,))
-    chat = cur.fetchone()
-    cur.close()
-    conn.close()
-    
+    chat = get_private_chat(chat_id)
     if not chat:
         return
     
     receiver_id = chat['user2_id'] if chat['user1_id'] == user_data['id'] else chat['user1_id']
     
     try:
-        if ',' in file_data:
-            file_data = file_data.split(',')[1]
+        filename, attachment = store_base64_attachment(file_data, filename)
+        post_private_file(user_data, chat_id, receiver_id, filename, attachment)
         
-        filename = secure_filename(filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        with open(filepath, 'wb') as f:
-            f.write(base64.b64decode(file_data))
-        
-        saved = save_private_message(
-            chat_id=chat_id,
-            sender_id=user_data['id'],
-            receiver_id=receiver_id,
-            msg_type='file',
-            filename=filename,
-            filepath=f'/uploads/{filename}'
-        )
-        
-        if not saved:
+    except Exception as e:
+        print(f'❌ Error sending private file: {e}')
+        emit('private_file_error', {'error': 'Ошибка при отправке файла'})
+
+# === ЗАГРУЗКА ФАЙЛОВ ЧАНКАМИ ===
+uploads_in_progress = {}  # {upload_id: {'user_id', 'chat_id', 'filename', 'size', 'received', 'sha256', 'path'}}
+
+# Состояние загрузки лежит на диске рядом с частичным файлом (<upload_id>.json), а uploads_in_progress —
+# только локальный кеш воркера: после переподключения к другому воркеру загрузка продолжается с того же места
+# (PARTIAL_FOLDER должен быть общим для всех воркеров — один диск или общий том)
+def upload_meta_path(upload_id):
+    return os.path.join(app.config['PARTIAL_FOLDER'], f'{upload_id}.json')
+
+def save_upload(upload_id, upload):
+    with open(upload_meta_path(upload_id), 'w') as f:
+        json.dump({key: upload[key] for key in ('user_id', 'chat_id', 'filename', 'size')}, f)
+    uploads_in_progress[upload_id] = upload
+
+def load_upload(upload_id):
+    """Загрузка по upload_id: из кеша, если он совпадает с файлом на диске, иначе заново с диска."""
+    if not isinstance(upload_id, str) or not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+        return None
+    path = os.path.join(app.config['PARTIAL_FOLDER'], upload_id)
+    try:
+        received = os.path.getsize(path)
+        upload = uploads_in_progress.get(upload_id)
+        if upload and upload['received'] == received:
+            return upload
+        with open(upload_meta_path(upload_id)) as f:
+            upload = json.load(f)
+        # Хеш уже принятой части пересчитывается по файлу: объект hashlib между процессами не передать
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                sha256.update(block)
+    except (OSError, ValueError):
+        uploads_in_progress.pop(upload_id, None)
+        return None
+    
+    upload.update(received=received, sha256=sha256, path=path)
+    uploads_in_progress[upload_id] = upload
+    return upload
+
+def discard_upload(upload_id):
+    """Снимает загрузку с учёта; False, если её уже забрал другой воркер."""
+    uploads_in_progress.pop(upload_id, None)
+    try:
+        os.remove(upload_meta_path(upload_id))
+        return True
+    except OSError:
+        return False
+
+def expire_uploads():
+    # Просрочку видно по mtime частичного файла, поэтому чистятся и загрузки других воркеров
+    now = time.time()
+    folder = app.config['PARTIAL_FOLDER']
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        upload_id = name[:-len('.json')]
+        path = os.path.join(folder, upload_id)
+        try:
+            if now - os.path.getmtime(path) <= UPLOAD_TTL:
+                continue
+        except OSError:
+            pass
+        if discard_upload(upload_id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def get_upload_user(data):
+    """Пользователь сокета для upload_*; без входа (например, сразу после переподключения) — upload_error.
+
+    Флаг auth_required говорит клиенту не бросать загрузку: он продолжит её после session_result.
+    """
+    user_data = users.get(request.sid)
+    if not user_data:
+        emit('upload_error', {'upload_id': (data or {}).get('upload_id'), 'error': 'Требуется вход', 'auth_required': True})
+    return user_data
+
+def get_own_upload(upload_id, user_data):
+    upload = load_upload(upload_id)
+    if not upload or upload['user_id'] != user_data['id']:
+        emit('upload_error', {'upload_id': upload_id, 'error': 'Загрузка не найдена'})
+        return None
+    return upload
+
+@on_event('upload_init')
+def handle_upload_init(data):
+    user_data = get_upload_user(data)
+    if not user_data:
+        return
+    
+    expire_uploads()
+    
+    # Повторный init с upload_id — продолжение после переподключения
+    upload_id = data.get('upload_id')
+    if upload_id:
+        upload = get_own_upload(upload_id, user_data)
+        if upload:
+            os.utime(upload['path'])
+            emit('upload_ready', {'upload_id': upload_id, 'offset': upload['received']})
+        return
+    
+    chat_id = data.get('chat_id')
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    
+    if not chat_id or not filename or not isinstance(size, int) or size <= 0:
+        emit('upload_error', {'error': 'Некорректный файл'})
+        return
+    
+    if size > UPLOAD_MAX_SIZE:
+        emit('upload_error', {'error': f'Файл слишком большой! Максимум {UPLOAD_MAX_SIZE // (1024 * 1024)} МБ'})
+        return
+    
+    if chat_id != 'general':
+        chat = get_private_chat(chat_id)
+        if not chat or user_data['id'] not in (chat['user1_id'], chat['user2_id']):
+            emit('upload_error', {'error': 'Чат не найден'})
             return
+    
+    upload_id = secrets.token_hex(16)
+    path = os.path.join(app.config['PARTIAL_FOLDER'], upload_id)
+    open(path, 'wb').close()
+    save_upload(upload_id, {
+        'user_id': user_data['id'],
+        'chat_id': chat_id,
+        'filename': filename,
+        'size': size,
+        'received': 0,
+        'sha256': hashlib.sha256(),
+        'path': path
+    })
+    emit('upload_ready', {'upload_id': upload_id, 'offset': 0})
+
+@on_event('upload_chunk')
+def handle_upload_chunk(data):
+    user_data = get_upload_user(data)
+    if not user_data:
+        return
+    
+    upload_id = data.get('upload_id')
+    upload = get_own_upload(upload_id, user_data)
+    if not upload:
+        return
+    
+    # Фрагмент не с того места (повтор после обрыва) — сообщаем клиенту, откуда продолжать.
+    # Проверяется до размера: устаревший фрагмент у конца файла не должен обрывать загрузку
+    if data.get('offset') != upload['received']:
+        emit('upload_ready', {'upload_id': upload_id, 'offset': upload['received']})
+        return
+    
+    chunk = data.get('data')
+    if not isinstance(chunk, (bytes, bytearray)) or len(chunk) > UPLOAD_CHUNK_SIZE \
+            or upload['received'] + len(chunk) > upload['size']:
+        emit('upload_error', {'upload_id': upload_id, 'error': 'Некорректный фрагмент файла'})
+        return
+    
+    with open(upload['path'], 'ab') as f:
+        f.write(chunk)
+    upload['sha256'].update(chunk)
+    upload['received'] += len(chunk)
+    
+    emit('upload_ack', {'upload_id': upload_id, 'offset': upload['received']})
+
+@on_event('upload_commit')
+def handle_upload_commit(data):
+    user_data = get_upload_user(data)
+    if not user_data:
+        return
+    
+    upload_id = data.get('upload_id')
+    upload = get_own_upload(upload_id, user_data)
+    if not upload:
+        return
+    
+    if upload['received'] != upload['size']:
+        emit('upload_ready', {'upload_id': upload_id, 'offset': upload['received']})
+        return
+    
+    if not discard_upload(upload_id):
+        emit('upload_error', {'upload_id': upload_id, 'error': 'Загрузка не найдена'})
+        return
+    update_last_seen(user_data['id'])
+    
+    try:
+        filename = upload['filename']
+        attachment = store_attachment(upload['path'], upload['sha256'].hexdigest(), filename, upload['size'])
         
-        emit('new_private_message', {
-            'id': saved['id'],
-            'chat_id': chat_id,
-            'sender_id': user_data['id'],
-            'sender_name': user_data['username'],
-            'sender_tag': user_data['tag'],
-            'sender_avatar': user_data['avatar'],
-            'filename': filename,
-            'filepath': f'/uploads/{filename}',
-            'type': 'file',
-            'is_favorite': False,
-            'time': saved['created_at'].strftime('%H:%M')
-        }, room=chat_id)
+        if upload['chat_id'] == 'general':
+            post_general_file(user_data, filename, attachment)
+        else:
+            chat = get_private_chat(upload['chat_id'])
+            receiver_id = chat['user2_id'] if chat['user1_id'] == user_data['id'] else chat['user1_id']
+            post_private_file(user_data, upload['chat_id'], receiver_id, filename, attachment)
         
+        emit('upload_done', {'upload_id': upload_id})
     except Exception as e:
-        print(f'❌ Error sending private file: {e}')
-        emit('private_file_error', {'error': 'Ошибка при отправке файла'})
+        print(f'❌ Error committing upload: {e}')
+        emit('upload_error', {'upload_id': upload_id, 'error': 'Ошибка при отправке файла'})
 
-@socketio.on('get_private_chat_history')
+@on_event('get_private_chat_history')
 def handle_get_private_chat_history(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -862,28 +2340,81 @@ def handle_get_private_chat_history(data):
     history = get_private_chat_history(chat_id, user_data['id'])
     emit('get_private_chat_history', history)
 
-@socketio.on('join_private_chat')
+@on_event('get_message_page')
+def handle_get_message_page(data):
+    user_data = users.get(request.sid)
+    page = parse_page_request(data or {})
+    if not page:
+        return
+    
+    before_id, after_id, limit = page
+    user_id = user_data['id'] if user_data else None
+    messages = None
+    if not before_id and not after_id:
+        messages = get_recent_history(user_id, limit + 1)
+    if messages is None:
+        messages = get_message_history(user_id, limit=limit + 1, before_id=before_id, after_id=after_id)
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if after_id else messages[1:]
+    
+    emit('message_page', {
+        'chat_id': 'general',
+        'before_id': before_id,
+        'after_id': after_id,
+        **with_profiles(messages),
+        'has_more': has_more
+    })
+
+@on_event('get_private_chat_page')
+def handle_get_private_chat_page(data):
+    user_data = users.get(request.sid)
+    if not user_data:
+        return
+    
+    chat_id = data.get('chat_id')
+    page = parse_page_request(data)
+    if not chat_id or not page:
+        return
+    
+    chat = get_private_chat(chat_id)
+    if not chat or user_data['id'] not in (chat['user1_id'], chat['user2_id']):
+        return
+    
+    before_id, after_id, limit = page
+    messages = get_private_chat_history(
+        chat_id, user_data['id'],
+        limit=limit + 1, before_id=before_id, after_id=after_id
+    )
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if after_id else messages[1:]
+    
+    emit('private_chat_page', {
+        'chat_id': chat_id,
+        'before_id': before_id,
+        'after_id': after_id,
+        'messages': messages,
+        'has_more': has_more
+    })
+
+@on_event('join_private_chat')
 def handle_join_private_chat(data):
     chat_id = data.get('chat_id')
     if not chat_id:
         return
     
-    join_room(chat_id)
-    if chat_id not in rooms:
-        rooms[chat_id] = []
-    rooms[chat_id].append(request.sid)
+    join_chat_room(chat_id)
 
-@socketio.on('leave_private_chat')
+@on_event('leave_private_chat')
 def handle_leave_private_chat(data):
     chat_id = data.get('chat_id')
     if not chat_id:
         return
     
-    leave_room(chat_id)
-    if chat_id in rooms and request.sid in rooms[chat_id]:
-        rooms[chat_id].remove(request.sid)
+    leave_chat_room(chat_id)
 
-@socketio.on('mark_chat_read')
+@on_event('mark_chat_read')
 def handle_mark_chat_read(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -893,9 +2424,10 @@ def handle_mark_chat_read(data):
     if not chat_id:
         return
     
-    updated = mark_messages_as_read(chat_id, user_data['id'])
+    if mark_messages_as_read(chat_id, user_data['id']):
+        emit('chat_read', {'chat_id': chat_id}, room=user_room(user_data['id']), include_self=False)
 
-@socketio.on('toggle_favorite')
+@on_event('toggle_favorite')
 def handle_toggle_favorite(data):
     user_data = users.get(request.sid)
     if not user_data:
@@ -921,10 +2453,11 @@ def handle_toggle_favorite(data):
     
     emit('favorite_toggled', {
         'message_id': message_id,
+        'chat_id': chat_id,
         'is_favorite': is_favorite
-    }, room=request.sid)
+    }, room=user_room(user_data['id']))
 
-@socketio.on('get_favorites')
+@on_event('get_favorites')
 def handle_get_favorites():
     user_data = users.get(request.sid)
     if not user_data:
@@ -933,52 +2466,67 @@ def handle_get_favorites():
     favorites = get_favorites(user_data['id'])
     emit('favorites_list', favorites)
 
-@socketio.on('get_message_history')
+@on_event('get_message_history')
 def handle_get_message_history():
     user_data = users.get(request.sid)
     user_id = user_data['id'] if user_data else None
-    history = get_message_history(user_id)
-    emit('message_history', history)
+    history = get_recent_history(user_id, 100)
+    emit('message_history', with_profiles(history))
 
-@socketio.on('search_users')
+@on_event('search_users')
 def handle_search_users(data):
     search_tag = data.get('tag', '')
     if len(search_tag) < 2:
         emit('search_results', [])
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, username, user_tag, avatar FROM users 
-        WHERE user_tag ILIKE %s AND user_tag IS NOT NULL
-        ORDER BY created_at DESC
-        LIMIT 20
-    """, (f'%{search_tag}%',))
-    users_list = cur.fetchall()
-    cur.close()
-    conn.close()
+    emit('search_results', search_users(search_tag))
+
+@on_event('search_messages')
+def handle_search_messages(data):
+    """Поиск по истории. Ответ: совпадения с подсвеченными фрагментами и курсор следующей страницы;
+    chat_id и id каждого совпадения годятся для get_message_page/get_private_chat_page."""
+    user_data = users.get(request.sid)
+    data = data or {}
+    query = (data.get('query') or '').strip()
+    page = parse_page_request(data)
+    if not user_data or not query or not page:
+        return
     
-    emit('search_results', users_list)
+    before = None
+    if data.get('cursor'):
+        before = decode_search_cursor(data['cursor'])
+        if not before:
+            return
+    
+    limit = page[2]
+    results = search_messages(user_data['id'], query, limit=limit + 1, before=before)
+    has_more = len(results) > limit
+    results = results[:limit]
+    
+    emit('message_search_results', {
+        'query': query,
+        'cursor': data.get('cursor'),
+        **with_profiles(results),
+        'next_cursor': results[-1]['cursor'] if has_more else None,
+        'has_more': has_more
+    })
 
-@socketio.on('update_profile')
+@on_event('update_profile')
 def handle_update_profile(data):
     user_data = users.get(request.sid)
     if not user_data:
         return
     
-    new_avatar = data.get('avatar')
-    if not new_avatar:
+    new_avatar = store_avatar(data.get('avatar'))
+    if not new_avatar or new_avatar == user_data['avatar']:
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET avatar = %s WHERE id = %s", (new_avatar, user_data['id']))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("UPDATE users SET avatar = %s WHERE id = %s", (new_avatar, user_data['id']))
     
     user_data['avatar'] = new_avatar
+    cache_user_profile(user_data['id'], user_data['username'], user_data['tag'], new_avatar)
     
     emit('profile_updated', {
         'user_id': user_data['id'],
@@ -987,10 +2535,63 @@ def handle_update_profile(data):
         'avatar': new_avatar
     }, broadcast=True)
 
+def send_immutable(directory, path, etag, mimetype=None):
+    """Отдача файла по адресу с хешем содержимого: ETag — сам хеш, кеш на год без перепроверки.
+
+    If-None-Match (304) и Range обрабатывает werkzeug; тело отдаётся через wsgi.file_wrapper,
+    так что gunicorn использует sendfile. С X_ACCEL_PREFIX ответ пустой, а файл по заголовку
+    X-Accel-Redirect отдаёт nginx (и Range тоже он).
+    """
+    prefix = app.config['X_ACCEL_PREFIX']
+    if prefix:
+        full_path = safe_join(directory, path)
+        if not full_path or not os.path.isfile(full_path):
+            abort(404)
+        relative = os.path.relpath(full_path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response = Response(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{relative}"
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        response = send_from_directory(directory, path, mimetype=mimetype, etag=etag,
+                                       max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Старые файлы лежат под исходным именем и могут быть перезаписаны — только перепроверка по ETag
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/files/<digest>/<name>')
+def attachment_file(digest, name):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        abort(404)
+    # Тип берётся из базы, а не из <name> в ссылке: имя в URL выбирает кто угодно
+    mime_type = get_attachment_mime_type(digest)
+    if not mime_type:
+        abort(404)
+    
+    response = send_immutable(os.path.dirname(attachment_path(digest)), digest, digest, mimetype=mime_type)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if mime_type not in IMAGE_TYPES and not mime_type.startswith(INLINE_PREFIXES):
+        response.headers.set('Content-Disposition', 'attachment', filename=secure_filename(name) or digest)
+    return response
+
+@app.route('/thumbs/<digest>.webp')
+def thumbnail_file(digest):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        abort(404)
+    path = thumbnail_path(digest)
+    return send_immutable(os.path.dirname(path), os.path.basename(path), f'{digest}-thumb', mimetype='image/webp')
+
+@app.route('/avatars/<name>')
+def avatar_file(name):
+    return send_immutable(app.config['AVATAR_FOLDER'], name, os.path.splitext(name)[0])
 
 if __name__ == '__main__':
+    init_db()
     port = int(os.environ.get('PORT', 5000))
     socketio.run(app, debug=True, host='0.0.0.0', port=port)
\ No newline at end of file